@@ -1,51 +1,24 @@
 import os
-import re
 import sys
+import time
 import traceback
 from datetime import datetime
 from tkinter import Tk, StringVar, BooleanVar, filedialog, messagebox
 from tkinter import ttk
 
-from PIL import Image, ImageOps  # pip install pillow
+from jpg2pdf_core import SORT_KEYS, JpgIndex, iter_images_for_pdf, sort_index, write_pdf
 
 
-def natural_key(s: str):
+def find_jpgs(folder: str) -> JpgIndex:
     """
-    Natural sort key: 'img2.jpg' < 'img10.jpg'
+    Return a JpgIndex of the .jpg/.jpeg files in 'folder' (non-recursive).
     """
-    return [int(text) if text.isdigit() else text.lower()
-            for text in re.split(r'(\d+)', s)]
-
-
-def find_jpgs(folder: str):
-    """
-    Return list of absolute paths to .jpg/.jpeg files (non-recursive).
-    """
-    exts = {".jpg", ".jpeg"}
-    items = []
-    for name in os.listdir(folder):
-        ext = os.path.splitext(name)[1].lower()
-        if ext in exts:
-            items.append(os.path.join(folder, name))
-    return items
-
-
-def load_images_for_pdf(paths):
-    """
-    Open images safely for PDF: fix EXIF orientation, ensure RGB.
-    Return list of PIL.Image objects (first image + rest list).
-    """
-    opened = []
-    for p in paths:
-        img = Image.open(p)
-        # Respect EXIF orientation & convert to RGB (PDF requires RGB or L)
-        img = ImageOps.exif_transpose(img)
-        if img.mode in ("RGBA", "P", "LA"):
-            img = img.convert("RGB")
-        elif img.mode not in ("RGB", "L"):
-            img = img.convert("RGB")
-        opened.append(img)
-    return opened
+    index = JpgIndex()
+    with os.scandir(folder) as it:
+        for e in it:
+            if e.name.lower().endswith((".jpg", ".jpeg")) and e.is_file():
+                index.add(e)
+    return index
 
 
 class JPG2PDFApp:
@@ -56,7 +29,7 @@ class JPG2PDFApp:
         # State
         self.folder_var = StringVar(value="")
         self.output_var = StringVar(value="")
-        self.sort_var = StringVar(value="Natural (img2 < img10)")
+        self.sort_var = StringVar(value=next(iter(SORT_KEYS)))
         self.resolution_var = StringVar(value="300")  # DPI for PDF metadata
         self.include_subfolders = BooleanVar(value=False)  # kept for future use (currently non-recursive)
 
@@ -84,13 +57,7 @@ class JPG2PDFApp:
         row += 1
         ttk.Label(frm, text="Sort order:").grid(row=row, column=0, sticky="w")
         sort_combo = ttk.Combobox(frm, textvariable=self.sort_var, state="readonly",
-                                  values=[
-                                      "Natural (img2 < img10)",
-                                      "Filename A → Z",
-                                      "Filename Z → A",
-                                      "Modified time (oldest → newest)",
-                                      "Modified time (newest → oldest)"
-                                  ])
+                                  values=list(SORT_KEYS))
         sort_combo.grid(row=row, column=1, sticky="we", **pad)
         sort_combo.current(0)
 
@@ -149,21 +116,6 @@ class JPG2PDFApp:
         if path:
             self.output_var.set(path)
 
-    def sort_paths(self, paths):
-        mode = self.sort_var.get()
-        if mode.startswith("Natural"):
-            return sorted(paths, key=lambda p: natural_key(os.path.basename(p)))
-        elif mode.startswith("Filename A"):
-            return sorted(paths, key=lambda p: os.path.basename(p).lower())
-        elif mode.startswith("Filename Z"):
-            return sorted(paths, key=lambda p: os.path.basename(p).lower(), reverse=True)
-        elif mode.startswith("Modified time (oldest"):
-            return sorted(paths, key=lambda p: os.path.getmtime(p))
-        elif mode.startswith("Modified time (newest"):
-            return sorted(paths, key=lambda p: os.path.getmtime(p), reverse=True)
-        else:
-            return paths
-
     def on_merge(self):
         folder = self.folder_var.get().strip()
         out_pdf = self.output_var.get().strip()
@@ -177,7 +129,7 @@ class JPG2PDFApp:
             messagebox.showwarning("No images", "No .jpg/.jpeg files found in the selected folder.")
             return
 
-        files = self.sort_paths(files)
+        files = sort_index(files, self.sort_var.get())
 
         if not out_pdf:
             messagebox.showerror("Error", "Please specify an output PDF path.")
@@ -202,35 +154,22 @@ class JPG2PDFApp:
         try:
             self.progress["value"] = 0
             self.progress["maximum"] = len(files)
-            self.status.config(text="Opening images…")
-
-            opened = []
-            for idx, p in enumerate(files, start=1):
-                opened.append(ImageOps.exif_transpose(Image.open(p)))
-                self.progress["value"] = idx
-                self.status.config(text=f"Loaded {idx}/{len(files)}: {os.path.basename(p)}")
-                self.root.update_idletasks()
-
-            # Convert to RGB as needed
-            first = opened[0]
-            if first.mode not in ("RGB", "L"):
-                first = first.convert("RGB")
-            rest = []
-            for img in opened[1:]:
-                if img.mode not in ("RGB", "L"):
-                    img = img.convert("RGB")
-                rest.append(img)
-
             self.status.config(text="Writing PDF…")
-            # Pillow uses the first image's size as the page size for all pages
-            first.save(out_pdf, "PDF", save_all=True, append_images=rest, resolution=dpi)
-
-            # Close images
-            for im in opened:
-                try:
-                    im.close()
-                except:
-                    pass
+
+            def pages():
+                # Images are decoded one by one while their pages are written;
+                # the window is redrawn at most every 100 ms
+                last_ui = 0.0
+                for idx, img in enumerate(iter_images_for_pdf(files), start=1):
+                    now = time.monotonic()
+                    if now - last_ui >= 0.1 or idx == len(files):
+                        last_ui = now
+                        self.progress["value"] = idx
+                        self.status.config(text=f"Writing {idx}/{len(files)}: {os.path.basename(files[idx - 1])}")
+                        self.root.update_idletasks()
+                    yield img
+
+            write_pdf(out_pdf, pages(), dpi)
 
             self.status.config(text=f"Done: {out_pdf}")
             messagebox.showinfo("Success", f"Merged {len(files)} image(s) into:\n{out_pdf}")
@@ -1,65 +1,84 @@
 import os
-import re
 import sys
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from tkinter import Tk, StringVar, BooleanVar, filedialog, messagebox
 from tkinter import ttk
 
-from PIL import Image, ImageOps  # pip install pillow
+from jpg2pdf_core import SORT_KEYS, JpgIndex, iter_images_for_pdf, sort_index, write_pdf
 
 
-def natural_key(s: str):
+def scan_folder(folder: str):
     """
-    Natural sort key: 'img2.jpg' < 'img10.jpg'
+    List 'folder' once. Return (JpgIndex, subfolder_paths); symlinked
+    subfolders are not followed.
     """
-    return [int(text) if text.isdigit() else text.lower()
-            for text in re.split(r'(\d+)', s)]
+    imgs, subdirs = JpgIndex(), []
+    with os.scandir(folder) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.path)
+            elif e.name.lower().endswith((".jpg", ".jpeg")) and e.is_file():
+                imgs.add(e)
+    return imgs, subdirs
 
 
-def find_jpgs(folder: str):
+def walk_jpgs(top: str):
     """
-    Return list of absolute paths to .jpg/.jpeg files (non-recursive).
+    Yield (dirpath, JpgIndex, mtime_ns) for 'top' and every subfolder,
+    top-down, listing each directory only once. The folder's mtime is taken
+    before listing it. Unreadable folders are skipped.
     """
-    exts = {".jpg", ".jpeg"}
-    items = []
-    for name in os.listdir(folder):
-        ext = os.path.splitext(name)[1].lower()
-        if ext in exts:
-            items.append(os.path.join(folder, name))
-    return items
+    try:
+        mtime = os.stat(top).st_mtime_ns
+        imgs, subdirs = scan_folder(top)
+    except OSError:
+        return
+    yield top, imgs, mtime
+    for d in subdirs:
+        yield from walk_jpgs(d)
 
 
-def load_images_for_pdf(paths):
-    """
-    Open images safely for PDF: fix EXIF orientation, ensure RGB or L.
-    Return list of PIL.Image objects.
-    """
-    opened = []
-    for p in paths:
-        img = Image.open(p)
-        img = ImageOps.exif_transpose(img)
-        if img.mode in ("RGBA", "P", "LA"):
-            img = img.convert("RGB")
-        elif img.mode not in ("RGB", "L"):
-            img = img.convert("RGB")
-        opened.append(img)
-    return opened
+def _folders_unchanged(dir_mtimes) -> bool:
+    try:
+        return all(os.stat(d).st_mtime_ns == mtime for d, mtime in dir_mtimes)
+    except OSError:
+        return False
 
 
 def ensure_unique_path(path: str) -> str:
     """
     If 'path' exists, append ' (2)', ' (3)', ... before extension.
     """
-    base, ext = os.path.splitext(path)
     if not os.path.exists(path):
         return path
+    folder, name = os.path.split(path)
+    base, ext = os.path.splitext(name)
+    # List the folder once instead of a stat per candidate. Compare
+    # case-insensitively so case-insensitive file systems are safe too.
+    with os.scandir(folder or ".") as it:
+        taken = {e.name.casefold() for e in it}
     i = 2
-    while True:
-        candidate = f"{base} ({i}){ext}"
-        if not os.path.exists(candidate):
-            return candidate
+    while f"{base} ({i}){ext}".casefold() in taken:
         i += 1
+    return os.path.join(folder, f"{base} ({i}){ext}")
+
+
+def write_pdf_for_folder(folder: str, img_paths, dpi: float, workers=None):
+    """
+    Write <folder>/<basename>_merged.pdf from the already sorted 'img_paths'.
+    Module-level so it can run in a worker process. Return the PDF path.
+    """
+    # Output path: <folder>/<basename>_merged.pdf (unique)
+    base = os.path.basename(os.path.normpath(folder)) or "merged"
+    out_pdf = os.path.join(folder, f"{base}_merged.pdf")
+    out_pdf = ensure_unique_path(out_pdf)
+
+    # Pages are decoded and written one at a time
+    write_pdf(out_pdf, iter_images_for_pdf(img_paths, workers=workers), dpi)
+    return out_pdf
 
 
 class JPG2PDFApp:
@@ -70,9 +89,10 @@ class JPG2PDFApp:
         # State
         self.folder_var = StringVar(value="")
         self.output_var = StringVar(value="")  # kept but unused in batch mode
-        self.sort_var = StringVar(value="Natural (img2 < img10)")
+        self.sort_var = StringVar(value=next(iter(SORT_KEYS)))
         self.resolution_var = StringVar(value="300")  # DPI for PDF metadata
         self.include_top_folder = BooleanVar(value=True)  # also process the chosen folder itself
+        self._targets_cache = None  # (key, [(dirpath, mtime_ns)], targets); see folders_with_images
 
         # UI
         pad = {"padx": 10, "pady": 6}
@@ -98,13 +118,7 @@ class JPG2PDFApp:
         row += 1
         ttk.Label(frm, text="Sort order:").grid(row=row, column=0, sticky="w")
         sort_combo = ttk.Combobox(frm, textvariable=self.sort_var, state="readonly",
-                                  values=[
-                                      "Natural (img2 < img10)",
-                                      "Filename A → Z",
-                                      "Filename Z → A",
-                                      "Modified time (oldest → newest)",
-                                      "Modified time (newest → oldest)"
-                                  ])
+                                  values=list(SORT_KEYS))
         sort_combo.grid(row=row, column=1, sticky="we", **pad)
         sort_combo.current(0)
 
@@ -153,84 +167,40 @@ class JPG2PDFApp:
         count_folders = 0
         count_imgs_total = 0
 
-        if self.include_top_folder.get():
-            imgs = find_jpgs(folder)
-            if imgs:
-                count_folders += 1
-                count_imgs_total += len(imgs)
-
-        for dirpath, dirnames, filenames in os.walk(folder):
-            if dirpath == folder:
-                continue  # skip top here; handled above according to toggle
-            imgs = find_jpgs(dirpath)
-            if imgs:
-                count_folders += 1
-                count_imgs_total += len(imgs)
+        for dirpath, imgs in self.folders_with_images(folder):
+            count_folders += 1
+            count_imgs_total += len(imgs)
 
         self.status.config(text=f"Found {count_imgs_total} image(s) across {count_folders} folder(s).")
 
-    def sort_paths(self, paths):
-        mode = self.sort_var.get()
-        if mode.startswith("Natural"):
-            return sorted(paths, key=lambda p: natural_key(os.path.basename(p)))
-        elif mode.startswith("Filename A"):
-            return sorted(paths, key=lambda p: os.path.basename(p).lower())
-        elif mode.startswith("Filename Z"):
-            return sorted(paths, key=lambda p: os.path.basename(p).lower(), reverse=True)
-        elif mode.startswith("Modified time (oldest"):
-            return sorted(paths, key=lambda p: os.path.getmtime(p))
-        elif mode.startswith("Modified time (newest"):
-            return sorted(paths, key=lambda p: os.path.getmtime(p), reverse=True)
-        else:
-            return paths
-
     def folders_with_images(self, top: str):
         """
-        Yield (dirpath, [image_paths]) for each folder that contains JPGs.
-        Respects include_top_folder toggle.
+        Return [(dirpath, JpgIndex)] for each folder that contains JPGs.
+        Respects include_top_folder toggle. The last scan is reused while no
+        scanned folder has changed, so a batch run right after
+        update_folder_stats doesn't list the whole tree again.
         """
-        if self.include_top_folder.get():
-            imgs = find_jpgs(top)
+        include_top = self.include_top_folder.get()
+        key = (top, include_top)
+        if self._targets_cache is not None:
+            cached_key, dir_mtimes, targets = self._targets_cache
+            if cached_key == key and _folders_unchanged(dir_mtimes):
+                # Re-saving or touching a file doesn't change its folder's
+                # mtime, so drop the file mtimes and let a sort re-read them
+                for _dirpath, imgs in targets:
+                    imgs.mtimes = None
+                return targets
+
+        dir_mtimes = []
+        targets = []
+        for dirpath, imgs, mtime in walk_jpgs(top):
+            dir_mtimes.append((dirpath, mtime))
+            if dirpath == top and not include_top:
+                continue
             if imgs:
-                yield top, imgs
-
-        for dirpath, dirnames, filenames in os.walk(top):
-            if dirpath == top:
-                continue  # top handled above (or skipped)
-            imgs = find_jpgs(dirpath)
-            if imgs:
-                yield dirpath, imgs
-
-    def write_pdf_for_folder(self, folder: str, img_paths, dpi: float):
-        # Sort images according to UI choice
-        img_paths = self.sort_paths(img_paths)
-
-        # Load images
-        opened = load_images_for_pdf(img_paths)
-        try:
-            first = opened[0]
-            if first.mode not in ("RGB", "L"):
-                first = first.convert("RGB")
-            rest = []
-            for im in opened[1:]:
-                if im.mode not in ("RGB", "L"):
-                    im = im.convert("RGB")
-                rest.append(im)
-
-            # Output path: <folder>/<basename>_merged.pdf (unique)
-            base = os.path.basename(os.path.normpath(folder)) or "merged"
-            out_pdf = os.path.join(folder, f"{base}_merged.pdf")
-            out_pdf = ensure_unique_path(out_pdf)
-
-            first.save(out_pdf, "PDF", save_all=True, append_images=rest, resolution=dpi)
-            return out_pdf
-        finally:
-            # Always close images
-            for im in opened:
-                try:
-                    im.close()
-                except:
-                    pass
+                targets.append((dirpath, imgs))
+        self._targets_cache = (key, dir_mtimes, targets)
+        return targets
 
     def on_batch_merge(self):
         folder = self.folder_var.get().strip()
@@ -245,7 +215,7 @@ class JPG2PDFApp:
             dpi = 300.0
 
         # Gather all target folders
-        targets = list(self.folders_with_images(folder))
+        targets = self.folders_with_images(folder)
         if not targets:
             messagebox.showwarning("No images", "No .jpg/.jpeg files found in the top folder or subfolders.")
             return
@@ -257,26 +227,45 @@ class JPG2PDFApp:
         made = 0
         errors = []
 
-        for idx, (dirpath, img_paths) in enumerate(targets, start=1):
-            rel = os.path.relpath(dirpath, folder)
-            if rel == ".":
-                rel_display = "(top folder)"
-            else:
-                rel_display = rel
-
-            try:
-                self.status.config(text=f"Processing {idx}/{len(targets)}: {rel_display} ({len(img_paths)} image(s))…")
-                self.root.update_idletasks()
-
-                out_pdf = self.write_pdf_for_folder(dirpath, img_paths, dpi)
-                made += 1
-                self.status.config(text=f"Created: {out_pdf}")
-            except Exception as e:
-                errors.append((dirpath, str(e), traceback.format_exc()))
-                self.status.config(text=f"Failed in {rel_display}: {e}")
-
-            self.progress["value"] = idx
-            self.root.update_idletasks()
+        # One folder per process; split the cores between each folder's decode threads
+        cpus = os.cpu_count() or 1
+        # ProcessPoolExecutor refuses more than 61 workers on Windows
+        procs = min(cpus, len(targets), 61 if os.name == "nt" else cpus)
+        workers = max(1, cpus // procs)
+
+        self.status.config(text=f"Processing {len(targets)} folder(s) on {procs} process(es)…")
+        self.root.update_idletasks()
+
+        with ProcessPoolExecutor(max_workers=procs) as pool:
+            futures = {}
+            order = self.sort_var.get()
+            for dirpath, imgs in targets:
+                fut = pool.submit(write_pdf_for_folder, dirpath, sort_index(imgs, order), dpi, workers)
+                futures[fut] = dirpath
+
+            last_ui = 0.0
+            for idx, fut in enumerate(as_completed(futures), start=1):
+                dirpath = futures[fut]
+                rel = os.path.relpath(dirpath, folder)
+                if rel == ".":
+                    rel_display = "(top folder)"
+                else:
+                    rel_display = rel
+
+                try:
+                    out_pdf = fut.result()
+                    made += 1
+                    self.status.config(text=f"Created {idx}/{len(targets)}: {out_pdf}")
+                except Exception as e:
+                    errors.append((dirpath, str(e), traceback.format_exc()))
+                    self.status.config(text=f"Failed in {rel_display}: {e}")
+
+                # Redraw at most every 100 ms
+                now = time.monotonic()
+                if now - last_ui >= 0.1 or idx == len(targets):
+                    last_ui = now
+                    self.progress["value"] = idx
+                    self.root.update_idletasks()
 
         # Summary
         if errors:
@@ -1,13 +1,22 @@
+import importlib.util
 import io
 import os
+import posixpath
+import re
 import sys
+import warnings
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
 from tkinter import Tk, filedialog, messagebox
 
 # ---- Dependencies ----
 try:
     import ebooklib
     from ebooklib import epub, ITEM_DOCUMENT, ITEM_IMAGE
-    from bs4 import BeautifulSoup
+    from bs4 import BeautifulSoup, SoupStrainer, XMLParsedAsHTMLWarning
     from reportlab.lib.pagesizes import A4
     from reportlab.pdfgen import canvas
     from reportlab.lib.units import cm
@@ -15,10 +24,15 @@ try:
     from reportlab.pdfbase.ttfonts import TTFont
     from reportlab.lib.utils import ImageReader
     from PIL import Image as PILImage
+    # BeautifulSoup's parser backend, much faster than html.parser. bs4
+    # imports it itself; only check it is there so a missing install gets
+    # the pip hint below
+    if importlib.util.find_spec("lxml") is None:
+        raise ImportError("No module named 'lxml'")
 except ImportError:
     sys.stderr.write(
         "Missing packages.\n"
-        "Run: pip install ebooklib beautifulsoup4 reportlab pillow\n"
+        "Run: pip install ebooklib beautifulsoup4 lxml reportlab pillow\n"
     )
     raise
 
@@ -30,116 +44,237 @@ DEFAULT_FONT_SIZE = 20
 H1_SIZE = 20
 H2_SIZE = 20
 H3_SIZE = 20
+TITLE_SIZE = 26  # book title on the first page
 QUOTE_INDENT = 0.0  # no extra indentation on a borderless page
 IMAGE_MAX_HEIGHT_RATIO = 0.98  # allow images to nearly fill the page height
+IMAGE_MAX_PX_PER_PT = 2  # larger images are downsampled to 2 px per drawn point
+IMAGE_JPEG_QUALITY = 85  # quality for downsampled images stored as JPEG
+
+# Tags the converter renders; chapters are parsed into a tree of these only
+BLOCK_TAGS = ["h1", "h2", "h3", "p", "blockquote", "img", "pre"]
+_BLOCK_SET = frozenset(BLOCK_TAGS)
+_TEXT_BLOCKS = frozenset({"p", "pre", "blockquote"})
+_STRAINER = SoupStrainer(BLOCK_TAGS + ["title"])
 
 # ---- Helpers for Japanese/CJK wrapping ----
-def is_cjk_char(ch: str) -> bool:
-    code = ord(ch)
-    return (
-        0x4E00 <= code <= 0x9FFF or
-        0x3400 <= code <= 0x4DBF or
-        0x3040 <= code <= 0x309F or
-        0x30A0 <= code <= 0x30FF or
-        0xFF00 <= code <= 0xFFEF or
-        0x3000 <= code <= 0x303F
-    )
+_CJK_RANGES = (
+    (0x4E00, 0x9FFF),  # CJK unified ideographs
+    (0x3400, 0x4DBF),  # CJK extension A
+    (0x3040, 0x309F),  # hiragana
+    (0x30A0, 0x30FF),  # katakana
+    (0xFF00, 0xFFEF),  # half/full-width forms
+    (0x3000, 0x303F),  # CJK symbols and punctuation
+)
+
+# One byte per BMP code point, 1 for CJK; all ranges above are in the BMP
+_CJK_BMP = bytearray(0x10000)
+for _lo, _hi in _CJK_RANGES:
+    _CJK_BMP[_lo:_hi + 1] = b"\1" * (_hi - _lo + 1)
+
+_WS_SPLIT = re.compile(r"(\s)")
+
+# One whitespace char, a CJK run, or a run of anything else. \s is
+# str.isspace; U+3000 (ideographic space) is in the CJK ranges but counts
+# as whitespace, hence the lookahead.
+_CJK_CLASS = "".join(f"{chr(lo)}-{chr(hi)}" for lo, hi in _CJK_RANGES)
+_TOKEN_RE = re.compile(rf"\s|(?:(?!\s)[{_CJK_CLASS}])+|[^\s{_CJK_CLASS}]+")
 
 def tokenize_for_wrap(text: str):
-    tokens, buf, last_cjk = [], "", None
-    for ch in text:
-        if ch == "\u00A0":
-            ch = " "
-        if ch.isspace():
-            if buf:
-                tokens.append(buf); buf = ""
-            tokens.append(ch); last_cjk = None
-            continue
-        cjk = is_cjk_char(ch)
-        if last_cjk is None:
-            buf = ch; last_cjk = cjk
-        else:
-            if cjk != last_cjk:
-                tokens.append(buf); buf = ch; last_cjk = cjk
-            else:
-                if cjk:
-                    tokens.append(buf); buf = ch
-                else:
-                    buf += ch
-    if buf:
-        tokens.append(buf)
-    return tokens
+    # Split into whitespace chars, non-CJK words and CJK runs. A CJK run is
+    # one token even though a line may break before any of its chars;
+    # wrap_cjk_aware places the whole run at once. The regex slices each
+    # token out of the text once instead of growing it char by char.
+    if text.isascii():
+        # No CJK and no NBSP possible: just words and whitespace chars
+        return [tk for tk in _WS_SPLIT.split(text) if tk]
+    return _TOKEN_RE.findall(text.replace("\u00A0", " "))
+
+class _Advances(dict):
+    """
+    Per-character advance widths of one font at size 1000 (glyph space units,
+    as fonts store them), measured on first use. Scale by 0.001 * font_size
+    for points, so every size shares one table.
+    """
+    def __init__(self, font_name: str):
+        super().__init__()
+        self.font_name = font_name
+
+    def __missing__(self, ch):
+        w = self[ch] = pdfmetrics.stringWidth(ch, self.font_name, 1000)
+        return w
+
+# font_name -> _Advances
+_advance_cache = {}
 
-def str_width(s: str, font_name: str, font_size: float) -> float:
-    return pdfmetrics.stringWidth(s, font_name, font_size)
+def char_widths(font_name: str) -> _Advances:
+    widths = _advance_cache.get(font_name)
+    if widths is None:
+        widths = _advance_cache[font_name] = _Advances(font_name)
+    return widths
+
+def prewarm_widths(chars, font_name: str):
+    widths = char_widths(font_name)
+    for ch in chars - widths.keys():
+        widths[ch] = pdfmetrics.stringWidth(ch, font_name, 1000)
+
+def split_to_width(tk: str, max_width: float, widths) -> list:
+    # Break a token that is too wide into pieces of at most max_width (at
+    # least one char each, same units as widths): bisect the running width
+    # instead of re-measuring the piece after every character.
+    ends = list(accumulate(map(widths.__getitem__, tk)))
+    pieces, start, base = [], 0, 0.0
+    while start < len(tk):
+        end = max(bisect_right(ends, base + max_width, start), start + 1)
+        pieces.append(tk[start:end])
+        base = ends[end - 1]
+        start = end
+    return pieces
 
 def wrap_cjk_aware(text: str, max_width: float, font_name: str, font_size: float):
+    return list(_wrap_cached(text, max_width, font_name, font_size))
+
+# Headings, scene breaks ("◆ ◆ ◆") and other short lines repeat a lot in
+# light novels; wrapping is a pure function of these arguments, so reuse it.
+@lru_cache(maxsize=4096)
+def _wrap_cached(text: str, max_width: float, font_name: str, font_size: float) -> tuple:
+    cjk_bmp = _CJK_BMP
+    # Work in the font's 1000-unit glyph space: scale the limit once
+    # instead of every width
+    widths = char_widths(font_name)
+    limit = max_width / (0.001 * font_size)
+    space_width = widths[" "]
     lines = []
     for raw in text.splitlines() or [""]:
         if raw.strip() == "" and raw != "":
             lines.append(""); continue
         tokens = tokenize_for_wrap(raw)
-        cur = ""
+        # The line's width is kept as a running total, so each token costs
+        # one measurement of itself rather than of the whole line so far.
+        cur, cur_width, cur_ends_space = "", 0.0, False
         for tk in tokens:
             if tk == " ":
-                if cur and not cur.endswith(" "):
-                    trial = cur + " "
-                    if str_width(trial, font_name, font_size) <= max_width:
-                        cur = trial
+                if cur and not cur_ends_space and cur_width + space_width <= limit:
+                    cur += " "
+                    cur_width += space_width
+                    cur_ends_space = True
                 continue
-            add = tk
-            if cur == "":
-                if str_width(add, font_name, font_size) <= max_width:
-                    cur = add
-                else:
-                    piece = ""
-                    for ch in add:
-                        if str_width(piece + ch, font_name, font_size) <= max_width:
-                            piece += ch
-                        else:
-                            if piece: lines.append(piece)
-                            piece = ch
-                    cur = piece
+            if tk[0] <= "\uffff" and cjk_bmp[ord(tk[0])]:
+                # CJK run: fill the line with one bisect over the run's
+                # running widths, then cut the rest into full lines the same
+                # way; an empty line always takes at least one char.
+                ends = list(accumulate(map(widths.__getitem__, tk)))
+                k = bisect_right(ends, limit - cur_width)
+                if k == 0 and not cur:
+                    k = 1
+                if k:
+                    cur += tk[:k]
+                    cur_width += ends[k - 1]
+                if k < len(tk):
+                    lines.append(cur.rstrip())
+                    *full, cur = split_to_width(tk[k:], limit, widths)
+                    lines.extend(full)
+                    cur_width = sum(map(widths.__getitem__, cur))
+                cur_ends_space = False
+                continue
+            add_width = sum(map(widths.__getitem__, tk))
+            if cur and cur_width + add_width <= limit:
+                cur += tk
+                cur_width += add_width
             else:
-                trial = cur + add
-                if str_width(trial, font_name, font_size) <= max_width:
-                    cur = trial
-                else:
+                if cur:
                     lines.append(cur.rstrip())
-                    if str_width(add, font_name, font_size) > max_width:
-                        piece = ""
-                        for ch in add:
-                            if str_width(piece + ch, font_name, font_size) <= max_width:
-                                piece += ch
-                            else:
-                                if piece: lines.append(piece)
-                                piece = ch
-                        cur = piece
-                    else:
-                        cur = add
+                if add_width <= limit:
+                    cur, cur_width = tk, add_width
+                else:
+                    *full, cur = split_to_width(tk, limit, widths)
+                    lines.extend(full)
+                    cur_width = sum(map(widths.__getitem__, cur))
+            cur_ends_space = False
         lines.append(cur.rstrip())
-    return lines
+    return tuple(lines)
 
 # ---- PDF drawing helpers (no footer, no margins) ----
+def set_font(c, font_name, font_size):
+    # Skip setFont when the canvas already has this font; showPage resets
+    # the canvas state, so the first call on a new page still goes through.
+    if c._fontname != font_name or c._fontsize != font_size:
+        c.setFont(font_name, font_size)
+
 def draw_paragraph(c, text, x, y, right_x, font_name, font_size, indent_left=0):
     leading = font_size * LINE_SPACING
+    bottom = MARGIN + leading  # a line starting below this won't fit
     max_width = right_x - (x + indent_left)
     lines = wrap_cjk_aware(text, max_width, font_name, font_size)
-    c.setFont(font_name, font_size)
+    # One text object (a single BT..ET block) per page of the paragraph;
+    # textLine moves down by the leading, so lines need no positioning.
+    t = None
     for line in lines:
-        if y - leading < MARGIN:  # bottom edge
+        if y < bottom:  # bottom edge
+            if t is not None:
+                c.drawText(t); t = None
             c.showPage()
-            c.setFont(font_name, font_size)
             y = PAGE_SIZE[1] - MARGIN  # top edge
-        c.drawString(x + indent_left, y - leading, line)
+        if t is None:
+            t = c.beginText(x + indent_left, y - leading)
+            t.setFont(font_name, font_size, leading)
+        t.textLine(line)
         y -= leading
+    if t is not None:
+        c.drawText(t)
     return y
 
-def draw_image(c, pil_img, x, y, right_x, font_name):
+def fit_scale(img_w, img_h, max_w) -> float:
+    return min(max_w / img_w, (PAGE_SIZE[1] * IMAGE_MAX_HEIGHT_RATIO) / img_h)
+
+def downsample(raw: bytes, max_w: float) -> bytes:
+    # Images far larger than their drawn size (e.g. 3000x4500 manga scans)
+    # are shrunk to IMAGE_MAX_PX_PER_PT and re-encoded, so the PDF doesn't
+    # carry pixels no reader will ever show.
+    pil = PILImage.open(io.BytesIO(raw))
+    img_w, img_h = pil.size
+    px = fit_scale(img_w, img_h, max_w) * IMAGE_MAX_PX_PER_PT
+    if px >= 1:
+        return raw
+    mode = pil.mode
+    # thumbnail falls back to NEAREST for bilevel and palette images, which
+    # drops thin lines, and can't resize 16-bit ones at all
+    if mode == "1" or mode.startswith("I;16"):
+        pil = pil.convert("L")
+    elif mode in ("P", "PA"):
+        pil = pil.convert("RGBA" if mode == "PA" or "transparency" in pil.info else "RGB")
+    pil.thumbnail((max(1, int(img_w * px)), max(1, int(img_h * px))), PILImage.LANCZOS)
+    buf = io.BytesIO()
+    if mode in ("1", "P", "PA", "LA", "RGBA"):
+        pil.save(buf, format="PNG")  # line art / transparency
+    else:
+        if pil.mode not in ("RGB", "L"):
+            pil = pil.convert("RGB")
+        pil.save(buf, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+    return buf.getvalue()
+
+def image_reader(raw: bytes, max_w: float) -> ImageReader:
+    raw = downsample(raw, max_w)
+    # JPEG and PNG go to ReportLab as they are. Only JPEG is a passthrough,
+    # embedded untouched as DCTDecode; ReportLab still decodes a PNG and
+    # Flate-compresses the pixels, but it skips the PIL -> PNG round trip.
+    # Other formats (GIF, WebP, ...) are decoded by Pillow.
+    if raw.startswith((b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")):
+        reader = ImageReader(io.BytesIO(raw))
+    else:
+        pil = PILImage.open(io.BytesIO(raw))
+        if pil.mode not in ("RGB", "L"):  # ReportLab embeds these as they are
+            pil = pil.convert("RGB")
+        reader = ImageReader(pil)
+    # drawImage decodes the pixels anyway (it hashes them to reuse repeated
+    # images); doing it here makes a broken image fail before a page break.
+    reader.getRGBData()
+    return reader
+
+def draw_image(c, img, x, y, right_x, font_name):
     page_w, page_h = PAGE_SIZE
     max_w = right_x - x
-    img_w, img_h = pil_img.size
-    scale = min(max_w / img_w, (page_h * IMAGE_MAX_HEIGHT_RATIO) / img_h)
+    img_w, img_h = img.getSize()
+    scale = fit_scale(img_w, img_h, max_w)
     draw_w = img_w * scale
     draw_h = img_h * scale
 
@@ -147,9 +282,7 @@ def draw_image(c, pil_img, x, y, right_x, font_name):
         c.showPage()
         y = page_h - MARGIN
 
-    buf = io.BytesIO()
-    pil_img.save(buf, format="PNG"); buf.seek(0)
-    c.drawImage(ImageReader(buf), x, y - draw_h, width=draw_w, height=draw_h,
+    c.drawImage(img, x, y - draw_h, width=draw_w, height=draw_h,
                 preserveAspectRatio=True, mask="auto")
     y -= draw_h
     return y
@@ -171,12 +304,76 @@ def pick_font():
     return font_name, font_path
 
 # ---- EPUB → PDF core (borderless) ----
+@lru_cache(maxsize=4096)
+def resolve_href(item_dir: str, src: str) -> str:
+    # EPUB hrefs are always '/'-separated, whatever the OS
+    return posixpath.normpath(posixpath.join(item_dir, src))
+
+def read_chapter(item, href_map):
+    """
+    Parse one spine document into (chapter_title, blocks), where blocks is a
+    list of (tag name, text) for text blocks and ("img", image item) for
+    images, in document order.
+    """
+    item_dir = posixpath.dirname(item.get_name())
+    with warnings.catch_warnings():
+        # EPUB chapters are XHTML; lxml's HTML parser reads them fine and is
+        # lenient about the markup errors real-world books contain, so
+        # silence bs4's hint.
+        warnings.simplefilter("ignore", XMLParsedAsHTMLWarning)
+        soup = BeautifulSoup(item.get_content(), "lxml", parse_only=_STRAINER)
+
+    # Chapter title
+    chapter_title = None
+    for tag in ["h1", "h2", "title"]:
+        t = soup.find(tag)
+        if t and t.get_text(strip=True):
+            chapter_title = t.get_text(strip=True); break
+
+    blocks = []
+    # One walk over the (strained) tree in document order; strings have no
+    # name and fall through the set lookup. The lxml HTML parser lower-cases
+    # tag names, so they compare directly.
+    for b in soup.descendants:
+        name = getattr(b, "name", None)
+        if name not in _BLOCK_SET:
+            continue
+        if name in _TEXT_BLOCKS:
+            blocks.append((name, b.get_text("\n" if name == "pre" else " ", strip=True)))
+        elif name == "img":
+            src = b.get("src")
+            if not src:
+                continue
+            target = href_map.get(src) or href_map.get(resolve_href(item_dir, src))
+            if target and target.get_type() == ITEM_IMAGE:
+                blocks.append((name, target))
+    return chapter_title, blocks
+
+def prefetch_images(pool, targets, max_w, depth):
+    # Yield one future per image (see image_reader), submitting ahead of
+    # the consumer but keeping at most 'depth' decoded images waiting, so a
+    # long manga isn't held in memory all at once.
+    pending = deque()
+    for target in targets:
+        pending.append(pool.submit(image_reader, target.get_content(), max_w))
+        if len(pending) > depth:
+            yield pending.popleft()
+    yield from pending
+
 def convert_epub_to_pdf(epub_path, pdf_path, font_name):
     book = epub.read_epub(epub_path)
 
-    spine_ids = [sid for sid, _ in book.spine]
-    id_to_item = {it.id: it for it in book.get_items()}
-    href_map = {it.get_name(): it for it in book.get_items()}
+    id_to_item, href_map = {}, {}
+    for it in book.get_items():
+        id_to_item[it.id] = it
+        name = it.get_name()
+        href_map[name] = it
+        href_map.setdefault(posixpath.normpath(name), it)
+
+    # Spine documents in reading order
+    doc_items = [id_to_item[sid] for sid, _ in book.spine
+                 if sid in id_to_item and id_to_item[sid].get_type() == ITEM_DOCUMENT]
+    chapters = [read_chapter(item, href_map) for item in doc_items]
 
     c = canvas.Canvas(pdf_path, pagesize=PAGE_SIZE)
     x_left = MARGIN
@@ -190,65 +387,61 @@ def convert_epub_to_pdf(epub_path, pdf_path, font_name):
     except Exception:
         title = None
 
+    # Measure every char the book uses up front, so wrapping below only
+    # looks widths up
+    used = set(title or "")
+    for chapter_title, blocks in chapters:
+        used.update(chapter_title or "")
+        for name, obj in blocks:
+            if name != "img":
+                used.update(obj)
+    prewarm_widths(used, font_name)
+
     if title:
-        c.setFont(font_name, 26)
-        for line in wrap_cjk_aware(title, x_right - x_left, font_name, 26):
+        set_font(c, font_name, TITLE_SIZE)
+        for line in wrap_cjk_aware(title, x_right - x_left, font_name, TITLE_SIZE):
             if y - 30 < MARGIN:
-                c.showPage(); c.setFont(font_name, 26)
+                c.showPage(); set_font(c, font_name, TITLE_SIZE)
                 y = PAGE_SIZE[1] - MARGIN
             c.drawString(x_left, y - 30, line); y -= 38
         y -= 12  # small gap
 
-    for sid in spine_ids:
-        item = id_to_item.get(sid)
-        if item is None or item.get_type() != ITEM_DOCUMENT:
-            continue
-        soup = BeautifulSoup(item.get_content(), "html.parser")
-
-        # Chapter title
-        chapter_title = None
-        for tag in ["h1", "h2", "title"]:
-            t = soup.find(tag)
-            if t and t.get_text(strip=True):
-                chapter_title = t.get_text(strip=True); break
-
-        if chapter_title:
-            c.setFont(font_name, H1_SIZE)
-            for line in wrap_cjk_aware(chapter_title, x_right - x_left, font_name, H1_SIZE):
-                if y - (H1_SIZE + 6) < MARGIN:
-                    c.showPage(); c.setFont(font_name, H1_SIZE)
-                    y = PAGE_SIZE[1] - MARGIN
-                c.drawString(x_left, y - (H1_SIZE + 6), line)
-                y -= (H1_SIZE + 10)
-            y -= 4
+    # Images are decoded on a pool in book order while the main thread lays
+    # out the text; the img blocks below take the results in the same order.
+    images = [obj for _, blocks in chapters for name, obj in blocks if name == "img"]
+    workers = os.cpu_count() or 1
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        decoded = prefetch_images(pool, images, x_right - x_left, 2 * workers)
+        for chapter_title, blocks in chapters:
+            if chapter_title:
+                set_font(c, font_name, H1_SIZE)
+                for line in wrap_cjk_aware(chapter_title, x_right - x_left, font_name, H1_SIZE):
+                    if y - (H1_SIZE + 6) < MARGIN:
+                        c.showPage(); set_font(c, font_name, H1_SIZE)
+                        y = PAGE_SIZE[1] - MARGIN
+                    c.drawString(x_left, y - (H1_SIZE + 6), line)
+                    y -= (H1_SIZE + 10)
+                y -= 4
 
-        # Content flow
-        blocks = soup.find_all(["h1", "h2", "h3", "p", "blockquote", "img", "pre"])
-        for b in blocks:
-            name = (b.name or "").lower()
-            if name in ("p", "pre", "blockquote"):
-                text = b.get_text("\n" if name == "pre" else " ", strip=True)
-                indent = QUOTE_INDENT if name == "blockquote" else 0.0
-                y = draw_paragraph(c, text, x_left, y, x_right, font_name, DEFAULT_FONT_SIZE, indent)
-            elif name == "img":
-                src = b.get("src")
-                if not src:
-                    continue
-                target = href_map.get(src) or href_map.get(
-                    os.path.normpath(os.path.join(os.path.dirname(item.get_name()), src)).replace("\\", "/")
-                )
-                if target and target.get_type() == ITEM_IMAGE:
+            # Content flow
+            for name, obj in blocks:
+                if name == "img":
+                    future = next(decoded)
                     try:
-                        raw = target.get_content()
-                        pil = PILImage.open(io.BytesIO(raw)).convert("RGB")
-                        y = draw_image(c, pil, x_left, y, x_right, font_name)
+                        y = draw_image(c, future.result(), x_left, y, x_right, font_name)
                     except Exception:
                         pass
-        # tiny gap between chapters
-        y -= 4
-        if y < MARGIN + 20:
-            c.showPage()
-            y = PAGE_SIZE[1] - MARGIN
+                else:
+                    indent = QUOTE_INDENT if name == "blockquote" else 0.0
+                    y = draw_paragraph(c, obj, x_left, y, x_right, font_name, DEFAULT_FONT_SIZE, indent)
+            # tiny gap between chapters
+            y -= 4
+            if y < MARGIN + 20:
+                c.showPage()
+                y = PAGE_SIZE[1] - MARGIN
+    finally:
+        pool.shutdown(cancel_futures=True)
 
     c.save()
 
@@ -0,0 +1,510 @@
+"""
+Image decoding and PDF writing shared by combinejpg.py and
+combinejpg02(batch).py. The GUI scripts only list folders and drive Tk.
+"""
+import io
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from PIL import Image  # pip install pillow
+
+try:
+    import numpy as np  # optional: pip install numpy
+except ImportError:
+    np = None
+
+try:
+    import simplejpeg  # optional, libjpeg-turbo decoder: pip install simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    from nvjpeg import NvJpeg  # optional, NVIDIA GPU decoder: pip install pynvjpeg
+except ImportError:
+    NvJpeg = None
+
+
+_NAT_RE = re.compile(r'\d+')
+
+
+def _nat_number(m) -> str:
+    digits = str(int(m.group()))  # any Unicode digits -> ASCII, no leading zeros
+    return "\0" + chr(len(digits)) + digits
+
+
+def natural_key(s: str) -> str:
+    """
+    Natural sort key: 'img2.jpg' < 'img10.jpg'
+    A single string, so sorting compares plain str objects. Each digit run
+    becomes '\0' + chr(digit count) + digits, which orders like the numbers
+    themselves; the '\0' makes text that stops before a number sort first.
+    """
+    return _NAT_RE.sub(_nat_number, s.lower())
+
+
+@dataclass
+class JpgIndex:
+    """
+    The JPGs of one folder as parallel lists (one per field) rather than a
+    list of per-file objects, so a sort only walks the column it compares.
+    On Windows the listing already carries each file's stat, so add() keeps
+    its mtime; elsewhere that would cost a syscall per file, so mtimes is
+    filled on first use instead (see file_mtimes()).
+    """
+    paths: list = field(default_factory=list)
+    names_lower: list = field(default_factory=list)
+    mtimes: list = field(default_factory=lambda: [] if os.name == "nt" else None)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, entry):
+        self.paths.append(entry.path)
+        self.names_lower.append(entry.name.lower())
+        if self.mtimes is not None:
+            self.mtimes.append(entry.stat().st_mtime)
+
+    def file_mtimes(self):
+        if self.mtimes is None:
+            self.mtimes = [os.stat(p).st_mtime for p in self.paths]
+        return self.mtimes
+
+
+# Sort order label -> (JpgIndex -> list of keys, reverse); the GUIs offer
+# these labels, in this order, in their sort combobox
+SORT_KEYS = {
+    "Natural (img2 < img10)": (lambda ix: [natural_key(n) for n in ix.names_lower], False),
+    "Filename A → Z": (lambda ix: ix.names_lower, False),
+    "Filename Z → A": (lambda ix: ix.names_lower, True),
+    "Modified time (oldest → newest)": (lambda ix: ix.file_mtimes(), False),
+    "Modified time (newest → oldest)": (lambda ix: ix.file_mtimes(), True),
+}
+
+
+def sort_index(index: JpgIndex, label: str) -> list:
+    """
+    Return the paths of 'index' in the SORT_KEYS order named 'label'.
+    Only the key column is built; the sort permutes indexes over it.
+    """
+    column, reverse = SORT_KEYS.get(label, (None, False))
+    if column is None:
+        return list(index.paths)
+    keys = column(index)
+    order = sorted(range(len(index)), key=keys.__getitem__, reverse=reverse)
+    paths = index.paths
+    return [paths[i] for i in order]
+
+
+# EXIF orientation -> numpy equivalent of ImageOps.exif_transpose
+_ORIENTATION_OPS = {
+    2: lambda a: a[:, ::-1],
+    3: lambda a: a[::-1, ::-1],
+    4: lambda a: a[::-1],
+    5: lambda a: a.swapaxes(0, 1),
+    6: lambda a: np.rot90(a, -1),
+    7: lambda a: a.swapaxes(0, 1)[::-1, ::-1],
+    8: lambda a: np.rot90(a),
+}
+# Same, for when numpy is not installed
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def apply_orientation(img, orientation: int):
+    """
+    Rotate/flip an RGB or L image as its EXIF orientation tag says.
+    Orientation 1 (the usual case) returns the image untouched.
+    """
+    if orientation not in _ORIENTATION_OPS:
+        return img
+    if np is None:
+        return img.transpose(_ORIENTATION_TRANSPOSE[orientation])
+    arr = _ORIENTATION_OPS[orientation](np.asarray(img))
+    return Image.fromarray(np.ascontiguousarray(arr))
+
+
+# EXIF orientations that are pure rotations -> PDF page /Rotate (clockwise)
+_PAGE_ROTATE = {1: 0, 3: 180, 6: 90, 8: 270}
+
+
+class JpegPage:
+    """
+    A JPEG file embedded into the PDF as-is, without decoding or re-encoding.
+    """
+
+    def __init__(self, data: bytes, size, mode: str, rotate: int = 0):
+        self.data = data
+        self.size = size
+        self.mode = mode
+        self.rotate = rotate
+
+    def close(self):
+        self.data = None
+
+
+def passthrough_jpeg(data: bytes):
+    """
+    Return a JpegPage if the JPEG can go into the PDF untouched: baseline,
+    RGB/YCbCr or grayscale, not mirrored by EXIF and not an MPO (whose extra
+    images would be embedded too). Otherwise return None.
+    """
+    hdr = jpeg_header(data)
+    if (hdr is None or hdr["mpo"] or not hdr["baseline"] or hdr["components"] not in (1, 3)
+            or hdr["orientation"] not in _PAGE_ROTATE):
+        return None
+    mode = "L" if hdr["components"] == 1 else "RGB"
+    return JpegPage(data, hdr["size"], mode, _PAGE_ROTATE[hdr["orientation"]])
+
+
+def to_rgb(img):
+    """
+    Convert an image to RGB for PDF. Palette (P) and grayscale+alpha (LA)
+    images are expanded with numpy when available; other modes use convert().
+    """
+    if np is not None and img.mode == "P":
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        colors = np.array(img.getpalette() or [], dtype=np.uint8).reshape(-1, 3)
+        palette[:len(colors)] = colors[:256]
+        return Image.fromarray(palette[np.asarray(img)])
+    if np is not None and img.mode == "LA":
+        return Image.fromarray(np.repeat(np.asarray(img)[:, :, :1], 3, axis=2))
+    return img.convert("RGB")
+
+
+# Start-of-frame markers (SOF0-SOF15 minus DHT, JPG and DAC)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _exif_orientation(tiff: bytes) -> int:
+    """
+    Read the orientation (0x0112) from IFD0 of raw EXIF/TIFF data; 1 if
+    it is missing or unreadable.
+    """
+    try:
+        endian = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        ifd = struct.unpack_from(endian + "I", tiff, 4)[0]
+        count = struct.unpack_from(endian + "H", tiff, ifd)[0]
+        for i in range(count):
+            tag, _type, _count, value = struct.unpack_from(endian + "HHI4s", tiff, ifd + 2 + 12 * i)
+            if tag == 0x0112:
+                return struct.unpack_from(endian + "H", value)[0]
+    except (KeyError, struct.error):
+        pass
+    return 1
+
+
+def jpeg_header(data: bytes):
+    """
+    Walk the JPEG markers up to the first SOF segment without decoding
+    anything. Return a dict with size, components, baseline, orientation
+    (EXIF) and mpo (an MPF segment, i.e. more images are appended after
+    this one), or None if 'data' isn't a usable JPEG.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    info = {"orientation": 1, "mpo": False}
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # no length field
+            pos += 2
+            continue
+        seg_len = struct.unpack_from(">H", data, pos + 2)[0]
+        seg = data[pos + 4:pos + 2 + seg_len]
+        if marker in _SOF_MARKERS:
+            if len(seg) < 6:
+                return None
+            precision, h, w, components = struct.unpack_from(">BHHB", seg)
+            info["size"] = (w, h)
+            info["components"] = components
+            info["baseline"] = marker in (0xC0, 0xC1) and precision == 8
+            return info
+        if marker == 0xE1 and seg[:6] == b"Exif\0\0":
+            info["orientation"] = _exif_orientation(seg[6:])
+        elif marker == 0xE2 and seg[:4] == b"MPF\0":
+            info["mpo"] = True
+        elif marker == 0xDA:  # scan data before any SOF
+            return None
+        pos += 2 + seg_len
+    return None
+
+
+def decode_jpeg_turbo(data: bytes):
+    """
+    Decode JPEG bytes with simplejpeg (libjpeg-turbo) and apply EXIF orientation.
+    Return None if the file should go through Pillow instead (e.g. CMYK).
+    """
+    hdr = jpeg_header(data)
+    if hdr is None:
+        return None
+    orientation = hdr["orientation"]
+
+    try:
+        _h, _w, colorspace, _sub = simplejpeg.decode_jpeg_header(data)
+        if colorspace == "Gray":
+            colorspace = "GRAY"
+        elif colorspace in ("RGB", "YCbCr"):
+            colorspace = "RGB"
+        else:
+            return None
+        arr = simplejpeg.decode_jpeg(data, colorspace=colorspace)
+    except ValueError:
+        return None
+
+    if colorspace == "GRAY":
+        arr = arr[:, :, 0]
+    return apply_orientation(Image.fromarray(arr), orientation)
+
+
+_nvjpeg = None
+_nvjpeg_lock = threading.Lock()
+
+
+def decode_jpeg_gpu(data: bytes):
+    """
+    Decode JPEG bytes on the GPU with nvJPEG and apply EXIF orientation.
+    Return None when there is no usable GPU, or when the CPU path is the
+    better fit (e.g. CMYK).
+    """
+    global NvJpeg, _nvjpeg
+    hdr = jpeg_header(data)
+    if hdr is None or hdr["components"] not in (1, 3):
+        return None
+    with _nvjpeg_lock:
+        try:
+            if _nvjpeg is None:
+                _nvjpeg = NvJpeg()
+            bgr = _nvjpeg.decode(data)
+        except Exception:
+            if _nvjpeg is None:
+                NvJpeg = None  # no CUDA device; don't try again
+            return None
+    if bgr is None:
+        return None
+    arr = bgr[:, :, 0] if hdr["components"] == 1 else bgr[:, :, ::-1]
+    return apply_orientation(Image.fromarray(np.ascontiguousarray(arr)), hdr["orientation"])
+
+
+def open_image_for_pdf(p: str, data: bytes = None):
+    """
+    Open one image for PDF: fix EXIF orientation, ensure RGB or L.
+    'data' is the file content if it was already read (see prefetch_files).
+    Plain JPEGs come back as a JpegPage and are never decoded.
+    """
+    if data is None:
+        data = read_file(p)
+
+    if p.lower().endswith((".jpg", ".jpeg")):
+        page = passthrough_jpeg(data)
+        if page is not None:
+            return page
+        if NvJpeg is not None:
+            img = decode_jpeg_gpu(data)
+            if img is not None:
+                return img
+        if simplejpeg is not None:
+            img = decode_jpeg_turbo(data)
+            if img is not None:
+                return img
+
+    img = Image.open(io.BytesIO(data))
+    orientation = img.getexif().get(0x0112, 1)
+    img.load()  # decode here, on the worker thread
+    if img.mode not in ("RGB", "L"):
+        img = to_rgb(img)
+    return apply_orientation(img, orientation)
+
+
+def read_file(p: str):
+    """
+    Return the content of 'p' as bytes. Plain read() rather than mmap: the
+    I/O then happens on the prefetch thread instead of wherever the pages
+    are first touched, and a file truncated while being read (e.g. a
+    download still in progress) fails with an error instead of SIGBUS.
+    """
+    with open(p, "rb") as f:
+        return f.read()
+
+
+def prefetch_files(paths, depth: int = 4):
+    """
+    Yield (path, bytes) in order while a background thread reads up to
+    'depth' files ahead, so disk reads overlap with decoding.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for p in paths:
+                if not put((p, read_file(p), None)):
+                    return
+        except BaseException as e:
+            # Hand every error over; without an item the consumer's q.get()
+            # would wait forever
+            put((None, None, e))
+            return
+        put(None)
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            p, data, err = item
+            if err is not None:
+                raise err
+            yield p, data
+    finally:
+        stop.set()
+        t.join()
+
+
+def iter_images_for_pdf(paths, workers=None):
+    """
+    Yield images in order, ready for PDF (see open_image_for_pdf).
+    Decoding runs on a thread pool (libjpeg releases the GIL) at most
+    'workers' pages ahead of the consumer, and each image is closed once the
+    consumer moves on, so memory stays bounded by the pool size.
+    """
+    workers = workers or os.cpu_count() or 1
+    files = prefetch_files(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for p, data in files:
+                pending.append(pool.submit(open_image_for_pdf, p, data))
+                if len(pending) >= workers:
+                    break
+            while pending:
+                img = pending.popleft().result()
+                nxt = next(files, None)
+                if nxt is not None:
+                    pending.append(pool.submit(open_image_for_pdf, *nxt))
+                try:
+                    yield img
+                finally:
+                    img.close()
+        finally:
+            # Consumer stopped early or a decode failed: drop prefetched pages
+            files.close()
+            for fut in pending:
+                if not fut.cancel() and fut.exception() is None:
+                    fut.result().close()
+
+
+# Process umask, so files created with mkstemp can get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_pdf(out_pdf: str, images, dpi: float):
+    """
+    Write one page per image (or JpegPage) to 'out_pdf', streaming each page
+    to disk as soon as it is encoded. Page size follows the image size at
+    the given DPI.
+    Return the number of pages written.
+    The pages go to a temporary file next to 'out_pdf', which replaces
+    'out_pdf' only once every page is written; on failure an existing
+    'out_pdf' (e.g. from an earlier merge) is left untouched.
+    """
+    fd, tmp = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(out_pdf) or ".")
+    try:
+        pages = _write_pdf(os.fdopen(fd, "wb"), images, dpi)
+        os.chmod(tmp, 0o666 & ~_UMASK)  # mkstemp creates the file 0600
+        os.replace(tmp, out_pdf)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return pages
+
+
+def _write_pdf(f, images, dpi: float):
+    """
+    Write the PDF to the binary file object 'f' and close it.
+    """
+    offsets = {}  # object number -> byte offset
+    kids = []
+    with f:
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+        def write_obj(num, entries, stream=None):
+            offsets[num] = f.tell()
+            if stream is None:
+                f.write(b"%d 0 obj\n<< %s >>\nendobj\n" % (num, entries))
+            else:
+                f.write(b"%d 0 obj\n<< %s /Length %d >>\nstream\n" % (num, entries, len(stream)))
+                f.write(stream)
+                f.write(b"\nendstream\nendobj\n")
+
+        num = 3  # 1 = catalog, 2 = page tree (written last)
+        for img in images:
+            # open_image_for_pdf is the only place modes are normalized
+            assert img.mode in ("RGB", "L"), img.mode
+            if isinstance(img, JpegPage):
+                stream, rotate = img.data, img.rotate
+            else:
+                buf = io.BytesIO()
+                img.save(buf, "JPEG")
+                stream, rotate = buf.getbuffer(), 0  # no copy of the encoded bytes
+            w, h = img.size
+            page_w, page_h = w * 72.0 / dpi, h * 72.0 / dpi
+            colorspace = b"/DeviceGray" if img.mode == "L" else b"/DeviceRGB"
+            img.close()  # pixels are not needed once encoded
+
+            write_obj(num, b"/Type /XObject /Subtype /Image /Width %d /Height %d "
+                           b"/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode"
+                      % (w, h, colorspace), stream)
+            write_obj(num + 1, b"", b"q %f 0 0 %f 0 0 cm /Im0 Do Q" % (page_w, page_h))
+            write_obj(num + 2, b"/Type /Page /Parent 2 0 R /MediaBox [0 0 %f %f] /Rotate %d "
+                               b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R"
+                      % (page_w, page_h, rotate, num, num + 1))
+            kids.append(num + 2)
+            num += 3
+
+        if not kids:
+            raise ValueError("No images to write.")
+
+        write_obj(2, b"/Type /Pages /Kids [%s] /Count %d"
+                  % (b" ".join(b"%d 0 R" % k for k in kids), len(kids)))
+        write_obj(1, b"/Type /Catalog /Pages 2 0 R")
+
+        xref_at = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % num)
+        for i in range(1, num):
+            f.write(b"%010d 00000 n \n" % offsets[i])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (num, xref_at))
+    return len(kids)